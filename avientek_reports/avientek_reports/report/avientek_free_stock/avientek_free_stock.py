@@ -88,10 +88,10 @@ def get_items_with_price(filters):
         """
         SELECT item_code, price_list_rate
         FROM `tabItem Price`
-        WHERE price_list = %s
-          AND item_code IN ({})
-        """.format(", ".join(["%s"] * len(item_codes))),
-        tuple(["Distributer Pricing1"] + item_codes),
+        WHERE price_list = %(price_list)s
+          AND item_code IN %(item_codes)s
+        """,
+        {"price_list": "Distributer Pricing1", "item_codes": tuple(item_codes)},
         as_dict=True
     )
 
@@ -119,10 +119,8 @@ def get_bin_data(item_codes):
     if not item_codes:
         return []
 
-    placeholders = ", ".join(["%s"] * len(item_codes))
-
     return frappe.db.sql(
-        f"""
+        """
         SELECT
             b.item_code,
             b.warehouse,
@@ -132,12 +130,12 @@ def get_bin_data(item_codes):
             b.indented_qty,
             b.projected_qty
         FROM `tabBin` b
-        WHERE b.item_code IN ({placeholders})
+        WHERE b.item_code IN %(item_codes)s
           AND b.warehouse NOT LIKE '%%RMA%%'
           AND b.warehouse NOT LIKE '%%DEMO%%'
         ORDER BY b.item_code, b.warehouse
         """,
-        tuple(item_codes),
+        {"item_codes": tuple(item_codes)},
         as_dict=True,
     )
 
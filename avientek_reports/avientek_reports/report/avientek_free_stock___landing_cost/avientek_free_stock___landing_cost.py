@@ -89,7 +89,6 @@ def _get_items(flt):
 #  BIN rows  (RMA / DEMO filtered)
 # ===========================================================
 def _get_bin_rows(item_codes):
-    ph = ", ".join(["%s"] * len(item_codes))
     return frappe.db.sql(
         f"""
         SELECT
@@ -99,10 +98,10 @@ def _get_bin_rows(item_codes):
             B.valuation_rate
         FROM `tabBin` B
         JOIN `tabWarehouse` W ON W.name = B.warehouse
-        WHERE B.item_code IN ({ph})
+        WHERE B.item_code IN %(item_codes)s
           {EXCLUDE_WH}
         """,
-        tuple(item_codes),
+        {"item_codes": tuple(item_codes)},
         as_dict=True,
     )
 
@@ -159,47 +158,52 @@ def _get_landed_cost(codes, companies):
                 SUM(B.actual_qty*B.valuation_rate) AS val
         FROM `tabBin` B
         JOIN `tabWarehouse` W ON W.name = B.warehouse
-        WHERE B.item_code IN ({", ".join(["%s"]*len(codes))})
+        WHERE B.item_code IN %(item_codes)s
           AND B.actual_qty > 0
           {EXCLUDE_WH}
         GROUP BY B.item_code, W.company
         """,
-        tuple(codes),
+        {"item_codes": tuple(codes)},
         as_dict=True,
     )
     for r in stock:
         rate[r.item_code][r.company] = flt(r.val) / flt(r.qty)
 
-    # 2) fallback → latest submitted PO
-    for it in codes:
-        for co in companies:
-            if rate[it][co]:
-                continue
-            po = frappe.db.sql(
-                """
-                SELECT PO.name
+    # 2) fallback → latest submitted PO (one query for every missing pair)
+    missing = {(it, co) for it in codes for co in companies if not rate[it][co]}
+    if missing:
+        miss_codes = sorted({it for it, _ in missing})
+        miss_cos   = sorted({co for _, co in missing})
+        # average rate per (item, company, PO), keeping only the newest
+        # PO of each pair → at most one row per pair
+        po_rates = frappe.db.sql(
+            """
+            SELECT item_code, company, r
+            FROM (
+                SELECT  POI.item_code, PO.company,
+                        AVG(POI.rate) AS r,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY POI.item_code, PO.company
+                            ORDER BY PO.transaction_date DESC, PO.creation DESC
+                        ) AS rn
                 FROM `tabPurchase Order` PO
                 JOIN `tabPurchase Order Item` POI ON POI.parent = PO.name
                 WHERE PO.docstatus = 1
-                  AND PO.company   = %s
-                  AND POI.item_code = %s
-                ORDER BY PO.transaction_date DESC, PO.creation DESC
-                LIMIT 1
-                """,
-                (co, it),
-                as_dict=True,
-            )
-            if po:
-                avg = frappe.db.sql(
-                    """
-                    SELECT AVG(rate) AS r
-                    FROM `tabPurchase Order Item`
-                    WHERE parent = %s AND item_code = %s
-                    """,
-                    (po[0].name, it),
-                    as_dict=True,
-                )
-                rate[it][co] = flt(avg[0].r) if avg else 0.0
+                  AND POI.item_code IN %(item_codes)s
+                  AND PO.company   IN %(companies)s
+                GROUP BY POI.item_code, PO.company, PO.name,
+                         PO.transaction_date, PO.creation
+            ) latest
+            WHERE rn = 1
+            """,
+            {"item_codes": tuple(miss_codes), "companies": tuple(miss_cos)},
+            as_dict=True,
+        )
+        for r in po_rates:
+            key = (r.item_code, r.company)
+            if key in missing:
+                rate[r.item_code][r.company] = flt(r.r)
+                missing.discard(key)
     return rate
 
 
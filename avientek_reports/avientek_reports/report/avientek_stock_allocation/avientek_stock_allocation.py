@@ -1,9 +1,16 @@
 # Copyright (c) 2025, QCS
 # licence information: see licence.txt
 
+import pickle
+
 import frappe
-from frappe.utils import flt
+from frappe import _
+from frappe.utils import cint
+from frappe.utils.caching import request_cache
 from collections import defaultdict
+from itertools import chain
+
+from avientek_reports.utils import chunked, run_in_parallel
 
 # ──────────────────────────────────────────────────────────────
 # CONSTANTS
@@ -13,13 +20,86 @@ EXCLUDE_WH = (
     "AND W.name NOT LIKE '%%DEMO%%' "
 )
 SO_STATUS_FILTER = "so.status = 'To Deliver and Bill'"
+# Fully delivered lines have nothing to allocate; drop them in SQL
+OPEN_LINE_FILTER = "soi.qty > soi.delivered_qty"
+REPORT_NAME = "Avientek Stock Allocation"
+_NO_PO = (0, 0)                         # (ordered, open) for SO lines without a PO
+ALLOWED_WH_CACHE_KEY = "avientek_stock_allocation_warehouses"
+BIN_CACHE_KEY = "avientek_stock_allocation_bins"     # hash: item_code -> aggregate
+FIFO_CACHE_KEY = "avientek_stock_allocation_lot_qty"
+# doc_events invalidate the caches above; the TTL bounds staleness from
+# any write path they miss (e.g. Bin rows updated with db_set)
+CACHE_TTL = 60                                       # seconds
+
+# ──────────────────────────────────────────────────────────────
+# SQL (assembled once at import; IN-lists are bound as tuples)
+# Frappe's MariaDB connection returns DECIMAL columns as float, and the
+# summed qty columns are NOT NULL, so aggregates need no flt() wrapping.
+# ──────────────────────────────────────────────────────────────
+_ALLOWED_WH_SQL = f"""
+    SELECT W.name, W.company
+    FROM `tabWarehouse` W
+    WHERE 1 = 1
+      {EXCLUDE_WH}
+"""
+
+# Bin and SLE are filtered on an explicit warehouse list, so the
+# (item_code, warehouse) indexes drive both reads without a join to
+# tabWarehouse or a LIKE scan per row.
+_BIN_SQL = """
+    SELECT B.item_code, B.warehouse,
+           B.actual_qty AS wh_qty,
+           B.reserved_qty AS dem_qty,
+           B.ordered_qty AS ord_qty
+    FROM `tabBin` B
+    WHERE B.item_code IN %(item_codes)s
+      AND B.warehouse IN %(warehouses)s
+"""
+
+# FIFO only ever takes min(need, stock left, lot qty left) from a
+# bucket, whatever the order or split of its lots — so the lot total
+# per (item, company) is all the allocation needs.
+_FIFO_SQL = """
+    SELECT SLE.item_code, SLE.company, SUM(SLE.actual_qty)
+    FROM `tabStock Ledger Entry` SLE
+    WHERE SLE.item_code IN %(item_codes)s
+      AND SLE.warehouse IN %(warehouses)s
+      AND SLE.actual_qty > 0
+    GROUP BY SLE.item_code, SLE.company
+"""
+
+# Submitted PO qty per SO line
+_PO_SQL = """
+    SELECT poi.sales_order_item,
+           SUM(poi.qty) AS tot,
+           SUM(poi.qty - poi.received_qty) AS open
+    FROM `tabPurchase Order Item` poi
+    JOIN `tabPurchase Order` po ON po.name = poi.parent
+    WHERE poi.sales_order_item IN %(so_detail_ids)s
+      AND po.docstatus = 1
+    GROUP BY poi.sales_order_item
+"""
 
 # ──────────────────────────────────────────────────────────────
 # REPORT ENTRY-POINT
 # ──────────────────────────────────────────────────────────────
 def execute(filters=None):
     filters = filters or {}
-    return get_columns(), get_data(filters)
+    return get_columns(), list(get_data(filters))
+
+@frappe.whitelist()
+def get_page(filters=None):
+    """Keyset-paginated rows for API callers.
+
+    `filters` takes the usual report filters plus `page_size` and, for
+    every page after the first, the `cursor` returned by the previous
+    call. Returns {"data": rows, "next_cursor": cursor-or-None}.
+    """
+    filters = frappe.parse_json(filters) or frappe._dict()
+    if not frappe.get_doc("Report", REPORT_NAME).is_permitted():
+        frappe.throw(_("Not permitted"), frappe.PermissionError)
+    data, next_cursor = _get_data(filters)
+    return {"data": list(data), "next_cursor": next_cursor}
 
 # ──────────────────────────────────────────────────────────────
 # COLUMN DEFINITIONS
@@ -61,70 +141,161 @@ def get_columns():
 # ──────────────────────────────────────────────────────────────
 # HELPER FUNCTIONS
 # ──────────────────────────────────────────────────────────────
-def make_bin_aggregate(item_codes, companies):
-    wh_cond = f"WHERE B.item_code IN ({', '.join(['%s'] * len(item_codes))}) {EXCLUDE_WH}"
-    wh_params = list(item_codes)
-    
-    if companies:
-        wh_cond += f" AND W.company IN ({', '.join(['%s'] * len(companies))})"
-        wh_params.extend(companies)
-        
-    rows = frappe.db.sql(
-        f"""
-        SELECT B.item_code, W.company,
-               SUM(B.actual_qty) AS wh_qty,
-               SUM(B.reserved_qty) AS dem_qty,
-               SUM(B.ordered_qty) AS ord_qty
-        FROM `tabBin` B
-        JOIN `tabWarehouse` W ON W.name = B.warehouse
-        {wh_cond}
-        GROUP BY B.item_code, W.company
-        """,
-        tuple(wh_params),
-        as_dict=True,
-    )
-    out = defaultdict(dict)
-    for r in rows:
-        out[r.item_code][r.company] = {"wh_qty": flt(r.wh_qty), "dem_qty": flt(r.dem_qty), "ord_qty": flt(r.ord_qty)}
+def get_allowed_warehouses():
+    """Warehouse -> company for every warehouse counted as free stock.
+    Cached until a Warehouse is changed (see hooks.doc_events)."""
+    wh_company = frappe.cache().get_value(ALLOWED_WH_CACHE_KEY)
+    if wh_company is None:
+        wh_company = dict(frappe.db.sql(_ALLOWED_WH_SQL))
+        frappe.cache().set_value(ALLOWED_WH_CACHE_KEY, wh_company, expires_in_sec=CACHE_TTL)
+    return wh_company
+
+def clear_allowed_warehouses(doc=None, method=None, *args, **kwargs):
+    # after_rename also passes (old, new, merge); the extras are unused.
+    # The per-item aggregates are built on top of the allowlist
+    for key in (ALLOWED_WH_CACHE_KEY, BIN_CACHE_KEY, FIFO_CACHE_KEY):
+        frappe.cache().delete_value(key)
+
+def clear_item_aggregates(doc=None, method=None):
+    """doc_events hook: drop the cached Bin / FIFO aggregates of every
+    item the document touches (SLE rows, or SO/PO item tables)."""
+    if doc.get("item_code"):
+        items = {doc.item_code}
+    else:
+        items = {d.item_code for d in doc.get("items") or [] if d.item_code}
+    cache = frappe.cache()
+    for item in items:
+        cache.hdel(BIN_CACHE_KEY, item)
+        cache.hdel(FIFO_CACHE_KEY, item)
+
+def _get_per_item(cache_key, item_codes, load):
+    """Per-item values from the Redis hash `cache_key`. Misses are built
+    with a single `load(missing_items)` call and written back. The hash
+    expires CACHE_TTL seconds after it was (re)created."""
+    cache = frappe.cache()
+    name = cache.make_key(cache_key)
+    out, missing = {}, []
+    for item, raw in zip(item_codes, cache.hmget(name, item_codes)):
+        if raw is None:
+            missing.append(item)
+        else:
+            out[item] = pickle.loads(raw)
+    if missing:
+        loaded = load(missing)
+        pipe = cache.pipeline()
+        for item in missing:
+            out[item] = loaded.get(item, {})
+            pipe.hset(name, item, pickle.dumps(out[item]))
+        pipe.execute()
+        if cache.ttl(name) < 0:
+            cache.expire(name, CACHE_TTL)
     return out
 
-def make_fifo_map(item_codes, companies):
-    wh_cond = f"WHERE SLE.item_code IN ({', '.join(['%s'] * len(item_codes))}) AND SLE.actual_qty > 0 {EXCLUDE_WH}"
-    wh_params = list(item_codes)
+def _load_bins(item_codes):
+    # item -> company -> [wh_qty, dem_qty, ord_qty]
+    out = defaultdict(dict)
+    wh_company = get_allowed_warehouses()
+    if not wh_company:
+        return out
+    rows = chain.from_iterable(
+        frappe.db.sql(_BIN_SQL, {"item_codes": chunk, "warehouses": tuple(wh_company)})
+        for chunk in chunked(item_codes)
+    )
+    for item, wh, wh_qty, dem_qty, ord_qty in rows:
+        qty = out[item].setdefault(wh_company[wh], [0.0, 0.0, 0.0])
+        qty[0] += wh_qty
+        qty[1] += dem_qty
+        qty[2] += ord_qty
+    return out
 
-    if companies:
-        wh_cond += f" AND W.company IN ({', '.join(['%s'] * len(companies))})"
-        wh_params.extend(companies)
-    
-    rows = frappe.db.sql(
-        f"""
-        SELECT SLE.item_code, W.company,
-               SLE.actual_qty, SLE.posting_date
-        FROM `tabStock Ledger Entry` SLE
-        JOIN `tabWarehouse` W ON W.name = SLE.warehouse
-        {wh_cond}
-        ORDER BY W.company, SLE.item_code, SLE.posting_date
-        """,
-        tuple(wh_params),
-        as_dict=True,
+def _load_lots(item_codes):
+    # item -> company -> total lot qty
+    wh_company = get_allowed_warehouses()
+    if not wh_company:
+        return {}
+    rows = chain.from_iterable(
+        frappe.db.sql(_FIFO_SQL, {"item_codes": chunk, "warehouses": tuple(wh_company)})
+        for chunk in chunked(item_codes)
     )
-    fifo = defaultdict(lambda: defaultdict(list))
-    for r in rows:
-        fifo[r.item_code][r.company].append({"qty": flt(r.actual_qty)})
+    out = {}
+    for item, comp, qty in rows:
+        out.setdefault(item, {})[comp] = qty
+    return out
+
+def make_bin_aggregate(item_codes, companies):
+    # Three flat (item_code, company) -> qty dicts, one per column
+    bin_wh, bin_dem, bin_ord = {}, {}, {}
+    for item, by_comp in _get_per_item(BIN_CACHE_KEY, item_codes, _load_bins).items():
+        for comp, (wh_qty, dem_qty, ord_qty) in by_comp.items():
+            if comp in companies:
+                key = (item, comp)
+                bin_wh[key] = wh_qty
+                bin_dem[key] = dem_qty
+                bin_ord[key] = ord_qty
+    return bin_wh, bin_dem, bin_ord
+
+def make_fifo_map(item_codes, companies):
+    # (item, company) -> total qty of the FIFO lots
+    fifo = {}
+    for item, by_comp in _get_per_item(FIFO_CACHE_KEY, item_codes, _load_lots).items():
+        for comp, lot_qty in by_comp.items():
+            if comp in companies:
+                fifo[(item, comp)] = lot_qty
     return fifo
 
-def clone_qty_map(src):
-    dup = defaultdict(dict)
-    for it, m in src.items():
-        for co, qty in m.items():
-            dup[it][co] = flt(qty)
-    return dup
+def allocate_fifo(sales_orders, stock_left, fifo_map):
+    """FIFO-allocate warehouse stock to every SO row.
+
+    Each (item_code, company) bucket can hand out at most
+    cap = min(stock left, lot total), first come first served. So the
+    qty served to a row and every row before it is min(cap, cum_need),
+    where `cum_need` is the bucket's running open qty in allocation order
+    (a window column of the SO query that also counts earlier pages).
+    A row's allocation is the step it adds to that curve.
+    `stock_left` and `fifo_map` are keyed by the bucket tuple.
+    Returns two lists aligned with `sales_orders`:
+    (allocated_qty, wh_qty_after_alloc).
+    """
+    _min = min
+    caps = {}       # bucket -> (cap, stock before allocation)
+    allocated = []
+    wh_after = []
+    for so in sales_orders:
+        key = (so.item_code, so.company)
+        bucket = caps.get(key)
+        if bucket is None:
+            stock = max(stock_left.get(key, 0.0), 0.0)
+            bucket = caps[key] = (max(_min(stock, fifo_map.get(key, 0.0)), 0.0), stock)
+        cap, stock = bucket
+
+        # Taking the step as min(balance, cap left after earlier rows)
+        # returns balance_qty itself for a fully served row, with no
+        # float residue from subtracting two points of the curve
+        prior = so.cum_need - so.balance_qty
+        allocated.append(_min(so.balance_qty, max(cap - prior, 0.0)))
+        wh_after.append(stock - _min(cap, so.cum_need))
+
+    return allocated, wh_after
+
+def get_po_maps(so_detail_ids):
+    """Return the PO figures of the fetched SO lines, keyed by SO line,
+    as (ordered qty, open qty) pairs so one lookup returns both."""
+    if not so_detail_ids:
+        return {}
+    return {
+        so_detail: (tot, open_qty)
+        for so_detail, tot, open_qty in frappe.db.sql(
+            _PO_SQL, {"so_detail_ids": tuple(so_detail_ids)}
+        )
+    }
 
+@request_cache
 def get_user_permission_values(user, doctype):
     """Thin wrapper around the shared helper in `avientek` app.
 
     Falls back to a local query if the avientek app isn't installed
-    (defensive — both apps are bench-mates in production).
+    (defensive — both apps are bench-mates in production). Memoised
+    for the current request, as permissions don't change mid-report.
     """
     try:
         from avientek.api.user_permission_utils import get_user_permission_values as _shared
@@ -170,6 +341,14 @@ def _intersect_with_permission(ui_value, allowed):
 
 
 def get_data(filters):
+    """Iterable of report rows (a generator once data is fetched)."""
+    return _get_data(filters)[0]
+
+
+def _get_data(filters):
+    """Return (rows, next_cursor); next_cursor is set only when
+    `page_size` is given and more rows may follow. All queries run
+    here — `rows` only assembles and yields the report lines."""
     # ── Pull every dimension the User Permission system can constrain ──
     # (Sridhar 2026-05-04: report must respect User Permissions across
     # ALL constrained DocTypes, not just Company + Sales Person.)
@@ -181,246 +360,234 @@ def get_data(filters):
     allowed_brands         = get_user_permission_values(user, "Brand")
     allowed_territories    = get_user_permission_values(user, "Territory")
 
-    so_cond = [SO_STATUS_FILTER]
-    sql_params = []
+    so_cond = [SO_STATUS_FILTER, OPEN_LINE_FILTER]
+    sql_params = {}
 
     # ── Company (UI ∩ Permissions) ─────────────────────────────────
     companies, denied = _intersect_with_permission(filters.get("company"), allowed_companies)
     if denied:
-        return []  # user picked a Company outside their permission set
+        return [], None  # user picked a Company outside their permission set
     if companies:
-        so_cond.append(f"so.company IN ({', '.join(['%s'] * len(companies))})")
-        sql_params.extend(companies)
+        so_cond.append("so.company IN %(companies)s")
+        sql_params["companies"] = tuple(companies)
 
     # Date filters (no UP restriction applies)
     if filters.get("from_date") and filters.get("to_date"):
-        so_cond.append("so.transaction_date BETWEEN %s AND %s")
-        sql_params.extend([filters["from_date"], filters["to_date"]])
+        so_cond.append("so.transaction_date BETWEEN %(from_date)s AND %(to_date)s")
+        sql_params.update(from_date=filters["from_date"], to_date=filters["to_date"])
 
     # Item filter
     if filters.get("item_code"):
-        so_cond.append("soi.item_code = %s")
-        sql_params.append(filters["item_code"])
+        so_cond.append("soi.item_code = %(item_code)s")
+        sql_params["item_code"] = filters["item_code"]
 
     # ── Customer (UI ∩ Permissions) ────────────────────────────────
     customer_ui = filters.get("customer") or filters.get("customer_name")
     customers, denied = _intersect_with_permission(customer_ui, allowed_customers)
     if denied:
-        return []
+        return [], None
     if customers:
-        so_cond.append(f"so.customer IN ({', '.join(['%s'] * len(customers))})")
-        sql_params.extend(customers)
+        so_cond.append("so.customer IN %(customers)s")
+        sql_params["customers"] = tuple(customers)
 
     # ── Item Group (UI ∩ Permissions) ──────────────────────────────
     # Item Group lives on tabItem, not on Sales Order Item — use a
     # sub-query in the WHERE constraint.
     item_groups, denied = _intersect_with_permission(filters.get("item_group"), allowed_item_groups)
     if denied:
-        return []
+        return [], None
     if item_groups:
         so_cond.append(
-            f"soi.item_code IN ("
-            f"SELECT name FROM `tabItem` WHERE item_group IN "
-            f"({', '.join(['%s'] * len(item_groups))}))"
+            "soi.item_code IN ("
+            "SELECT name FROM `tabItem` WHERE item_group IN %(item_groups)s)"
         )
-        sql_params.extend(item_groups)
+        sql_params["item_groups"] = tuple(item_groups)
 
     # ── Brand (UI ∩ Permissions) ───────────────────────────────────
     brands, denied = _intersect_with_permission(filters.get("brand"), allowed_brands)
     if denied:
-        return []
+        return [], None
     if brands:
-        so_cond.append(f"soi.brand IN ({', '.join(['%s'] * len(brands))})")
-        sql_params.extend(brands)
+        so_cond.append("soi.brand IN %(brands)s")
+        sql_params["brands"] = tuple(brands)
 
     # ── Territory (UI ∩ Permissions) ───────────────────────────────
     territories, denied = _intersect_with_permission(filters.get("territory"), allowed_territories)
     if denied:
-        return []
+        return [], None
     if territories:
-        so_cond.append(f"so.territory IN ({', '.join(['%s'] * len(territories))})")
-        sql_params.extend(territories)
+        so_cond.append("so.territory IN %(territories)s")
+        sql_params["territories"] = tuple(territories)
 
     where_so = "WHERE " + " AND ".join(so_cond)
 
-    # Fetch ALL relevant Sales Orders (only company/date/item restrictions)
-    sales_orders = frappe.db.sql(
-        f"""
-        SELECT  so.transaction_date, so.company,
-                so.name  AS sales_order,
-                (SELECT st.sales_person FROM `tabSales Team` st
-                 WHERE st.parent = so.name LIMIT 1) AS sales_person,
-                so.customer_name,
-                (SELECT addr.country FROM `tabAddress` addr
-                 WHERE addr.name = so.customer_address LIMIT 1) AS country,
-                soi.name AS so_detail,
-                soi.item_code, soi.part_number,
-                (SELECT item_name FROM `tabItem` WHERE name = soi.item_code) AS item_name,
-                soi.brand,
-                soi.qty AS sales_order_qty,
-                soi.delivered_qty,
-                (soi.qty - soi.delivered_qty) AS balance_qty,
-                soi.net_rate, soi.base_net_rate,
-                soi.net_amount, soi.base_net_amount,
-                soi.purchase_order AS po_number,
-                (SELECT po.transaction_date FROM `tabPurchase Order` po
-                 WHERE po.name = soi.purchase_order LIMIT 1) AS po_date
-        FROM `tabSales Order` so
-        JOIN `tabSales Order Item` soi ON soi.parent = so.name
-        {where_so}
-          AND so.docstatus = 1
-        ORDER BY so.transaction_date ASC
-        """, tuple(sql_params), as_dict=True
-    )
-
-    if not sales_orders:
-        return []
-
-    # Allocation logic (full dataset)
-    item_codes = list({r.item_code for r in sales_orders})
-    so_companies = list({r.company for r in sales_orders})
-    
-    bin_map = make_bin_aggregate(item_codes, so_companies)
-    fifo_map = make_fifo_map(item_codes, so_companies)
-    
-    sales_orders.sort(key=lambda x: x.transaction_date)
-    stock_left = clone_qty_map({it: {co: v["wh_qty"] for co, v in comp.items()} for it, comp in bin_map.items()})
-
-    # Purchase Order mapping
-    line_po_tot = defaultdict(float)
-    line_po_open = defaultdict(float)
-    fallback_po_tot = defaultdict(float)
-    fallback_po_open = defaultdict(float)
-
-    so_detail_ids = [r.so_detail for r in sales_orders if r.so_detail]
-    if so_detail_ids:
-        rows = frappe.db.sql(
-            f"""
-            SELECT sales_order_item,
-                   SUM(qty) AS tot,
-                   SUM(qty - received_qty) AS open
-            FROM `tabPurchase Order Item` poi
-            JOIN `tabPurchase Order` po ON po.name = poi.parent
-            WHERE poi.sales_order_item IN ({", ".join(["%s"] * len(so_detail_ids))})
-              AND po.docstatus = 1
-            GROUP BY sales_order_item
-            """, tuple(so_detail_ids), as_dict=True
+    # ── Keyset pagination (API callers; the report view fetches all) ──
+    # Pages run oldest first, matching the FIFO allocation order.
+    page_size = cint(filters.get("page_size"))
+    cursor = frappe.parse_json(filters.get("cursor")) if filters.get("cursor") else None
+    page_cond = ""
+    if cursor:
+        page_cond = (
+            "WHERE (ol.transaction_date, ol.sales_order, ol.so_idx)"
+            " > (%(cursor_date)s, %(cursor_so)s, %(cursor_idx)s)"
         )
-        for r in rows:
-            line_po_tot[r.sales_order_item] = flt(r.tot)
-            line_po_open[r.sales_order_item] = flt(r.open)
-
-    so_names = [r.sales_order for r in sales_orders]
-    if so_names:
-        rows = frappe.db.sql(
+        sql_params.update(cursor_date=cursor[0], cursor_so=cursor[1], cursor_idx=cursor[2])
+    limit = ""
+    if page_size:
+        limit = "LIMIT %(page_size)s"
+        sql_params["page_size"] = page_size
+
+    # Fetch ALL relevant Sales Orders (only company/date/item restrictions).
+    # The rows are streamed through an unbuffered cursor so the driver does
+    # not hold a second copy of the whole result set; the same pass
+    # collects every key set used below. Item name, customer country,
+    # PO date and the first Sales Team row are plain LEFT JOINs, applied
+    # to the filtered lines.
+    sales_orders = []
+    item_codes, so_companies = set(), set()
+    so_detail_ids = []
+    with frappe.db.unbuffered_cursor():
+        for r in frappe.db.sql(
             f"""
-            SELECT poi.sales_order, poi.item_code,
-                   SUM(poi.qty) AS tot,
-                   SUM(poi.qty - poi.received_qty) AS open
-            FROM `tabPurchase Order Item` poi
-            JOIN `tabPurchase Order` po ON po.name = poi.parent
-            WHERE poi.sales_order IN ({", ".join(["%s"] * len(so_names))})
-              AND po.docstatus = 1
-            GROUP BY poi.sales_order, poi.item_code
-            """, tuple(so_names), as_dict=True
-        )
-        for r in rows:
-            key = (r.sales_order, r.item_code)
-            fallback_po_tot[key] += flt(r.tot)
-            fallback_po_open[key] += flt(r.open)
-
-    so_item_qty_sum = defaultdict(float)
-    for row in sales_orders:
-        if not row.so_detail:
-            so_item_qty_sum[(row.sales_order, row.item_code)] += row.sales_order_qty
+            SELECT  ol.*,
+                    it.item_name,
+                    pod.transaction_date AS po_date,
+                    addr.country,
+                    st.sales_person
+            FROM (
+                SELECT  so.transaction_date, so.company,
+                        so.name  AS sales_order,
+                        so.customer_name, so.customer_address,
+                        soi.name AS so_detail, soi.idx AS so_idx,
+                        soi.item_code, soi.part_number,
+                        soi.brand,
+                        soi.qty AS sales_order_qty,
+                        soi.delivered_qty,
+                        (soi.qty - soi.delivered_qty) AS balance_qty,
+                        soi.net_rate, soi.base_net_rate,
+                        soi.net_amount, soi.base_net_amount,
+                        soi.purchase_order AS po_number,
+                        -- running open qty per bucket in allocation order,
+                        -- over every filtered line (earlier pages included)
+                        SUM(soi.qty - soi.delivered_qty) OVER (
+                            PARTITION BY soi.item_code, so.company
+                            ORDER BY so.transaction_date, so.name, soi.idx
+                        ) AS cum_need
+                FROM `tabSales Order` so
+                JOIN `tabSales Order Item` soi ON soi.parent = so.name
+                {where_so}
+                  AND so.docstatus = 1
+            ) ol
+            LEFT JOIN `tabItem` it ON it.name = ol.item_code
+            LEFT JOIN `tabPurchase Order` pod ON pod.name = ol.po_number
+            LEFT JOIN `tabAddress` addr ON addr.name = ol.customer_address
+            LEFT JOIN `tabSales Team` st
+                   ON st.parent = ol.sales_order
+                  AND st.parenttype = 'Sales Order'
+                  AND st.idx = 1
+            {page_cond}
+            ORDER BY ol.transaction_date ASC, ol.sales_order ASC, ol.so_idx ASC
+            {limit}
+            """, sql_params, as_dict=True, as_iterator=True
+        ):
+            sales_orders.append(r)
+            item_codes.add(r.item_code)
+            so_companies.add(r.company)
+            so_detail_ids.append(r.so_detail)
 
-    data = []
-    for so in sales_orders:
-        comp, item = so.company, so.item_code
-        bins = bin_map.get(item, {}).get(comp, {})
-        wh_qty_company = bins.get("wh_qty", 0)
-        total_demand = bins.get("dem_qty", 0)
-        total_ordered = bins.get("ord_qty", 0)
-
-        available = stock_left[item].get(comp, 0)
-        alloc = 0
-        if available > 0:
-            need = so.balance_qty
-            for lot in fifo_map[item].get(comp, []):
-                if need <= 0 or alloc >= available:
-                    break
-                take = min(lot["qty"], need, available - alloc)
-                alloc += take
-                need -= take
-                lot["qty"] -= take
-
-        stock_left[item][comp] = max(available - alloc, 0)
-        wh_after_alloc = stock_left[item][comp]
-        balance_to_allocate = so.balance_qty - alloc
-
-        if so.so_detail and so.so_detail in line_po_tot:
-            ordered_qty_so = line_po_tot[so.so_detail]
-            ordered_open_so = line_po_open.get(so.so_detail, 0)
-        else:
-            key = (so.sales_order, item)
-            g_tot, g_open = fallback_po_tot.get(key, 0), fallback_po_open.get(key, 0)
-            if g_tot:
-                share = so.sales_order_qty / so_item_qty_sum[key] if so_item_qty_sum[key] else 0
-                ordered_qty_so = flt(g_tot * share)
-                ordered_open_so = flt(g_open * share)
-            else:
-                ordered_qty_so = ordered_open_so = 0
-
-        balance_to_order_against_so = ordered_qty_so + wh_after_alloc - balance_to_allocate
-        total_balance_to_order = total_ordered + wh_qty_company - so.balance_qty
-
-        data.append({
-            "transaction_date": so.transaction_date,
-            "company": comp,
-            "sales_order": so.sales_order,
-            "sales_person": so.sales_person,
-            "customer": so.customer_name,
-            "country": so.country,
-            "brand": so.brand,
-            "part_number": so.part_number,
-            "item_code": item,
-            "item_name": so.item_name,
-            "net_rate": so.net_rate,
-            "base_net_rate": so.base_net_rate,
-            "net_amount": so.net_amount,
-            "base_net_amount": so.base_net_amount,
-            "total_demanded_qty": total_demand,
-            "sales_order_qty": so.sales_order_qty,
-            "delivered_qty": so.delivered_qty,
-            "balance_qty": so.balance_qty,
-            "total_wh_qty": wh_qty_company,
-            "allocated_qty": alloc,
-            "balance_to_allocate": balance_to_allocate,
-            "wh_qty_after_alloc": wh_after_alloc,
-            "total_ordered_qty": total_ordered,
-            "ordered_qty_against_so": ordered_qty_so,
-            "ordered_open_qty_against_so": ordered_open_so,
-            "po_date": so.po_date,
-            "po_number": so.po_number,
-            "so_ref_number": so.sales_order,
-            "balance_to_order_against_so": balance_to_order_against_so,
-            "total_balance_to_order": total_balance_to_order,
-        })
+    if not sales_orders:
+        return [], None
+
+    next_cursor = None
+    if page_size and len(sales_orders) == page_size:
+        last = sales_orders[-1]
+        next_cursor = [str(last.transaction_date), last.sales_order, last.so_idx]
+
+    item_codes = list(item_codes)
+
+    # Every lookup below is keyed only by the fetched rows, so they run
+    # side by side, each on its own connection:
+    #  - Bin / FIFO aggregates
+    #  - Purchase Order qty per SO line. Every row is joined from
+    #    tabSales Order Item, so it always has an SO line; there is no
+    #    per-(sales_order, item_code) fallback to share out.
+    (bin_wh, bin_dem, bin_ord), fifo_map, line_po = run_in_parallel(
+        (make_bin_aggregate, item_codes, so_companies),
+        (make_fifo_map, item_codes, so_companies),
+        (get_po_maps, so_detail_ids),
+    )
 
     # ─── Sales Person (UI ∩ Permissions) ────────────────────────────
-    # Sales Person comes from a tabSales Team sub-query so it can't be
-    # cleanly pre-filtered at SQL — apply intersection post-allocation.
+    # Sales Person only narrows the rows shown: other sales persons'
+    # orders still consume stock in FIFO order, so the intersection is
+    # applied post-allocation.
     effective_sps, denied = _intersect_with_permission(
         filters.get("sales_person"), allowed_sales_persons
     )
     if denied:
-        return []
-    if effective_sps:
-        sp_set = set(effective_sps)
-        data = [d for d in data if d.get("sales_person") in sp_set]
-
+        return [], None
+    sp_set = set(effective_sps) if effective_sps else None
     if filters.get("parent_sales_person"):
-        data = [d for d in data
-                if d.get("parent_sales_person") == filters["parent_sales_person"]]
-
-    return data
+        # every Sales Person below the parent in the tree (lft / rgt),
+        # not only its direct children
+        team = set(frappe.db.get_descendants("Sales Person", filters["parent_sales_person"]))
+        sp_set = team if sp_set is None else sp_set & team
+
+    allocated, wh_after = allocate_fifo(sales_orders, bin_wh, fifo_map)
+
+    # Rows are positional tuples, in get_columns() order, produced lazily
+    def iter_rows():
+        for idx, so in enumerate(sales_orders):
+            sales_person = so.sales_person
+            if sp_set is not None and sales_person not in sp_set:
+                continue
+
+            comp, item = so.company, so.item_code
+            bucket = (item, comp)
+            wh_qty_company = bin_wh.get(bucket, 0)
+            total_demand = bin_dem.get(bucket, 0)
+            total_ordered = bin_ord.get(bucket, 0)
+
+            alloc = allocated[idx]
+            wh_after_alloc = wh_after[idx]
+            balance_to_allocate = so.balance_qty - alloc
+
+            ordered_qty_so, ordered_open_so = line_po.get(so.so_detail, _NO_PO)
+
+            balance_to_order_against_so = ordered_qty_so + wh_after_alloc - balance_to_allocate
+            total_balance_to_order = total_ordered + wh_qty_company - so.balance_qty
+
+            yield (
+                so.transaction_date,
+                comp,
+                so.sales_order,
+                sales_person,
+                so.customer_name,
+                so.country,
+                so.brand,
+                so.part_number,
+                item,
+                so.item_name,
+                so.net_rate,
+                so.base_net_rate,
+                so.net_amount,
+                so.base_net_amount,
+                total_demand,
+                so.sales_order_qty,
+                so.delivered_qty,
+                so.balance_qty,
+                wh_qty_company,
+                alloc,
+                balance_to_allocate,
+                wh_after_alloc,
+                total_ordered,
+                ordered_qty_so,
+                ordered_open_so,
+                so.po_date,
+                so.po_number,
+                so.sales_order,
+                balance_to_order_against_so,
+                total_balance_to_order,
+            )
+
+    return iter_rows(), next_cursor
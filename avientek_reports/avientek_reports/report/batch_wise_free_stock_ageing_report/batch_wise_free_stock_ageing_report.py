@@ -2,13 +2,19 @@
 # For license information, please see license.txt
 # Based on erpnext/stock/report/batch_wise_balance_history/batch_wise_balance_history.py
 
+from datetime import datetime
+from operator import itemgetter
+
 import frappe
 from frappe import _
-from frappe.utils import cint, flt, getdate
+from frappe.query_builder import Case
+from frappe.utils import cint, flt, get_datetime
 from pypika import functions as fn
 
 from erpnext.stock.doctype.warehouse.warehouse import apply_warehouse_filter
 
+from avientek_reports.utils import chunked, run_in_parallel
+
 SLE_COUNT_LIMIT = 100_000
 
 
@@ -28,49 +34,60 @@ def execute(filters=None):
             _("Please select either the Item or Warehouse or Warehouse Type filter to generate the report.")
         )
 
-    if filters.get("from_date") and filters.get("to_date"):
-        if filters.from_date > filters.to_date:
-            frappe.throw(_("From Date must be before To Date"))
+    # Validate here, not in the queries: those run on worker threads
+    # (run_in_parallel), whose message log is discarded with the thread
+    if not filters.get("from_date"):
+        frappe.throw(_("'From Date' is required"))
+    if not filters.get("to_date"):
+        frappe.throw(_("'To Date' is required"))
+    if filters.from_date > filters.to_date:
+        frappe.throw(_("From Date must be before To Date"))
 
     float_precision = cint(frappe.db.get_default("float_precision")) or 3
 
     columns = get_columns()
-    item_map = get_item_details(filters)
-    batch_map = get_batch_details()
-    iwb_map = get_item_warehouse_batch_map(filters, float_precision)
-
-    # Get undelivered SO quantities per item+warehouse
-    so_reserved_map = get_so_reserved_qty(filters)
+    # The ledger scan and the undelivered SO quantities per item are
+    # independent, so they run side by side on separate connections
+    iwb_map, so_reserved_map = run_in_parallel(
+        (get_item_warehouse_batch_map, filters),
+        (get_so_reserved_qty, filters),
+    )
+    item_map = get_item_details({key[0] for key in iwb_map})
+    batch_map = get_batch_details({key[2] for key in iwb_map})
 
     # Calculate free stock using FIFO (oldest batch first)
     calculate_free_stock(iwb_map, so_reserved_map, batch_map, float_precision)
 
+    # Only show batches with positive balance; filter before the single
+    # sort on the (item, warehouse, batch) key
+    item_filter = filters.get("item")
+    rows = [
+        (key, qty_dict)
+        for key, qty_dict in iwb_map.items()
+        if (not item_filter or item_filter == key[0]) and flt(qty_dict.bal_qty, float_precision) > 0
+    ]
+    rows.sort(key=itemgetter(0))
+
     data = []
-    for item in sorted(iwb_map):
-        if not filters.get("item") or filters.get("item") == item:
-            for wh in sorted(iwb_map[item]):
-                for batch in sorted(iwb_map[item][wh]):
-                    qty_dict = iwb_map[item][wh][batch]
-                    # Only show batches with positive balance
-                    if flt(qty_dict.bal_qty, float_precision) > 0:
-                        item_details = item_map.get(item, {})
-                        batch_details = batch_map.get(batch, {})
-                        data.append(
-                            {
-                                "item_code": item,
-                                "item_name": item_details.get("item_name", ""),
-                                "description": item_details.get("description", ""),
-                                "warehouse": wh,
-                                "batch_no": batch,
-                                "manufacturing_date": batch_details.get("manufacturing_date"),
-                                "opening_qty": flt(qty_dict.opening_qty, float_precision),
-                                "in_qty": flt(qty_dict.in_qty, float_precision),
-                                "out_qty": flt(qty_dict.out_qty, float_precision),
-                                "balance_qty": flt(qty_dict.bal_qty, float_precision),
-                                "free_stock": flt(qty_dict.free_stock, float_precision),
-                                "stock_uom": item_details.get("stock_uom", ""),
-                            }
-                        )
+    for (item, wh, batch), qty_dict in rows:
+        item_details = item_map.get(item, {})
+        batch_details = batch_map.get(batch, {})
+        data.append(
+            {
+                "item_code": item,
+                "item_name": item_details.get("item_name", ""),
+                "description": item_details.get("description", ""),
+                "warehouse": wh,
+                "batch_no": batch,
+                "manufacturing_date": batch_details.get("manufacturing_date"),
+                "opening_qty": flt(qty_dict.opening_qty, float_precision),
+                "in_qty": flt(qty_dict.in_qty, float_precision),
+                "out_qty": flt(qty_dict.out_qty, float_precision),
+                "balance_qty": flt(qty_dict.bal_qty, float_precision),
+                "free_stock": flt(qty_dict.free_stock, float_precision),
+                "stock_uom": item_details.get("stock_uom", ""),
+            }
+        )
 
     return columns, data
 
@@ -93,19 +110,19 @@ def get_columns():
 
 
 def get_stock_ledger_entries(filters):
-    """Fetch stock ledger entries for batch items"""
-    entries = get_stock_ledger_entries_for_batch_no(filters)
-    entries += get_stock_ledger_entries_for_batch_bundle(filters)
-    return entries
+    """Stream stock ledger entries for batch items.
+
+    Rows come through an unbuffered cursor and are consumed once, so
+    neither result set is held in memory as a whole. Each query is
+    drained before the next one runs on the connection.
+    """
+    with frappe.db.unbuffered_cursor():
+        yield from get_stock_ledger_entries_for_batch_no(filters)
+        yield from get_stock_ledger_entries_for_batch_bundle(filters)
 
 
 def get_stock_ledger_entries_for_batch_no(filters):
     """Legacy batch_no field entries"""
-    if not filters.get("from_date"):
-        frappe.throw(_("'From Date' is required"))
-    if not filters.get("to_date"):
-        frappe.throw(_("'To Date' is required"))
-
     sle = frappe.qb.DocType("Stock Ledger Entry")
     query = (
         frappe.qb.from_(sle)
@@ -141,7 +158,7 @@ def get_stock_ledger_entries_for_batch_no(filters):
         if filters.get(field):
             query = query.where(sle[field] == filters.get(field))
 
-    return query.run(as_dict=True) or []
+    return aggregate_by_period(query, filters).run(as_iterator=True)
 
 
 def get_stock_ledger_entries_for_batch_bundle(filters):
@@ -188,71 +205,93 @@ def get_stock_ledger_entries_for_batch_bundle(filters):
         query = query.where(batch_package.batch_no == filters.get("batch_no"))
 
     try:
-        return query.run(as_dict=True) or []
+        return aggregate_by_period(query, filters).run(as_iterator=True)
     except Exception:
         # Serial and Batch Entry table might not exist in older versions
         return []
 
 
-def get_item_warehouse_batch_map(filters, float_precision):
-    """Build item -> warehouse -> batch map with qty calculations"""
+def aggregate_by_period(query, filters):
+    """Sum the per-voucher rows of `query` into opening / in / out
+    buckets per item, warehouse and batch, so the report receives at
+    most three rows per batch. A voucher counts as "in" or "out" by its
+    net qty, as before.
+
+    Rows are plain tuples of (item_code, warehouse, batch_no, bucket,
+    actual_qty), in that order."""
+    bucket = (
+        Case()
+        .when(query.posting_date < filters.get("from_date"), "open")
+        .when(query.actual_qty > 0, "in")
+        .else_("out")
+    )
+    return (
+        frappe.qb.from_(query)
+        .select(
+            query.item_code,
+            query.warehouse,
+            query.batch_no,
+            bucket.as_("bucket"),
+            fn.Sum(query.actual_qty).as_("actual_qty"),
+        )
+        .groupby(query.item_code, query.warehouse, query.batch_no, bucket)
+    )
+
+
+def get_item_warehouse_batch_map(filters):
+    """Build (item, warehouse, batch) -> qty map"""
     sle = get_stock_ledger_entries(filters)
     iwb_map = {}
 
-    from_date = getdate(filters["from_date"])
-    to_date = getdate(filters["to_date"])
-
-    for d in sle:
-        iwb_map.setdefault(d.item_code, {}).setdefault(d.warehouse, {}).setdefault(
-            d.batch_no,
-            frappe._dict({
+    for item_code, warehouse, batch_no, bucket, actual_qty in sle:
+        key = (item_code, warehouse, batch_no)
+        qty_dict = iwb_map.get(key)
+        if qty_dict is None:
+            qty_dict = iwb_map[key] = frappe._dict({
                 "opening_qty": 0.0,
                 "in_qty": 0.0,
                 "out_qty": 0.0,
                 "bal_qty": 0.0,
                 "free_stock": 0.0,
             })
-        )
-        qty_dict = iwb_map[d.item_code][d.warehouse][d.batch_no]
 
-        posting_date = getdate(d.posting_date)
+        # Accumulate raw floats; execute() rounds once when building rows
+        actual_qty = actual_qty or 0.0
+        if bucket == "open":
+            qty_dict.opening_qty += actual_qty
+        elif bucket == "in":
+            qty_dict.in_qty += actual_qty
+        else:
+            qty_dict.out_qty += abs(actual_qty)
 
-        if posting_date < from_date:
-            qty_dict.opening_qty = flt(qty_dict.opening_qty, float_precision) + flt(
-                d.actual_qty, float_precision
-            )
-        elif posting_date >= from_date and posting_date <= to_date:
-            if flt(d.actual_qty) > 0:
-                qty_dict.in_qty = flt(qty_dict.in_qty, float_precision) + flt(d.actual_qty, float_precision)
-            else:
-                qty_dict.out_qty = flt(qty_dict.out_qty, float_precision) + abs(
-                    flt(d.actual_qty, float_precision)
-                )
-
-        qty_dict.bal_qty = flt(qty_dict.bal_qty, float_precision) + flt(d.actual_qty, float_precision)
+        qty_dict.bal_qty += actual_qty
 
     return iwb_map
 
 
-def get_item_details(filters):
-    """Fetch item details"""
+def get_item_details(item_codes):
+    """Fetch item details for the items present in the report"""
     item_map = {}
-    for d in frappe.get_all(
-        "Item",
-        fields=["name", "item_name", "description", "stock_uom"],
-    ):
-        item_map[d.name] = d
+    for chunk in chunked(sorted(filter(None, item_codes))):
+        for d in frappe.get_all(
+            "Item",
+            filters={"name": ["in", chunk]},
+            fields=["name", "item_name", "description", "stock_uom"],
+        ):
+            item_map[d.name] = d
     return item_map
 
 
-def get_batch_details():
-    """Fetch batch details with manufacturing date"""
+def get_batch_details(batch_nos):
+    """Fetch manufacturing date of the batches present in the report"""
     batch_map = {}
-    for d in frappe.get_all(
-        "Batch",
-        fields=["name", "manufacturing_date", "creation"],
-    ):
-        batch_map[d.name] = d
+    for chunk in chunked(sorted(filter(None, batch_nos))):
+        for d in frappe.get_all(
+            "Batch",
+            filters={"name": ["in", chunk]},
+            fields=["name", "manufacturing_date", "creation"],
+        ):
+            batch_map[d.name] = d
     return batch_map
 
 
@@ -304,30 +343,31 @@ def calculate_free_stock(iwb_map, so_reserved_map, batch_map, float_precision):
     Reservation is at ITEM level (across all warehouses).
     Batches with negative balance are skipped.
     """
-    for item_code in iwb_map:
+    # Group every batch of an item across ALL warehouses, keyed by its
+    # manufacturing date (creation timestamp as fallback; neither -> last).
+    # Keys are datetimes so batches created on the same day keep their
+    # creation order.
+    # The key is computed once per batch, not per warehouse it sits in.
+    batch_key = {}
+    item_batches = {}
+    for (item_code, _warehouse, batch_no), qty_dict in iwb_map.items():
+        key = batch_key.get(batch_no)
+        if key is None:
+            batch_details = batch_map.get(batch_no, {})
+            mfg_date = batch_details.get("manufacturing_date") or batch_details.get("creation")
+            key = batch_key[batch_no] = get_datetime(mfg_date) if mfg_date else datetime.max
+        item_batches.setdefault(item_code, []).append((key, qty_dict))
+
+    for item_code, batches in item_batches.items():
         # Get reserved qty for this item (across all warehouses)
         reserved_qty = so_reserved_map.get(item_code, 0)
 
-        # Get all batches for this item across ALL warehouses, sorted by manufacturing_date (oldest first)
-        batches = []
-        for warehouse in iwb_map[item_code]:
-            for batch_no, qty_dict in iwb_map[item_code][warehouse].items():
-                batch_details = batch_map.get(batch_no, {})
-                mfg_date = batch_details.get("manufacturing_date") or batch_details.get("creation")
-                batches.append({
-                    "batch_no": batch_no,
-                    "warehouse": warehouse,
-                    "qty_dict": qty_dict,
-                    "mfg_date": mfg_date,
-                })
-
-        # Sort by manufacturing date (oldest first), None dates go to end
-        batches.sort(key=lambda x: (x["mfg_date"] is None, x["mfg_date"] or ""))
+        # Oldest first
+        batches.sort(key=itemgetter(0))
 
         remaining_reserved = flt(reserved_qty, float_precision)
 
-        for batch in batches:
-            qty_dict = batch["qty_dict"]
+        for _key, qty_dict in batches:
             bal_qty = flt(qty_dict.bal_qty, float_precision)
 
             # Skip negative balance batches
@@ -145,9 +145,30 @@ app_license = "mit"
 # }
 doc_events = {
     "User Permission": {
-        "after_insert": "avientek_reports.utils.rebuild_stock_allocation",
-        "on_update":    "avientek_reports.utils.rebuild_stock_allocation",
-    }
+        "after_insert": "avientek_reports.utils.queue_stock_allocation_rebuild",
+        "on_update":    "avientek_reports.utils.queue_stock_allocation_rebuild",
+    },
+    "Warehouse": {
+        "on_update":    "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_allowed_warehouses",
+        "after_rename": "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_allowed_warehouses",
+        "on_trash":     "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_allowed_warehouses",
+    },
+    "Stock Ledger Entry": {
+        "on_submit":    "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_item_aggregates",
+    },
+    "Bin": {
+        "on_update":    "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_item_aggregates",
+    },
+    "Sales Order": {
+        "on_submit":    "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_item_aggregates",
+        "on_cancel":    "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_item_aggregates",
+        "on_update_after_submit": "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_item_aggregates",
+    },
+    "Purchase Order": {
+        "on_submit":    "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_item_aggregates",
+        "on_cancel":    "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_item_aggregates",
+        "on_update_after_submit": "avientek_reports.avientek_reports.report.avientek_stock_allocation.avientek_stock_allocation.clear_item_aggregates",
+    },
 }
 
 # Scheduled Tasks
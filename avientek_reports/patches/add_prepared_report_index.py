@@ -0,0 +1,13 @@
+import frappe
+
+
+def execute():
+    # the stock allocation rebuild purges Prepared Report rows by
+    # (report_name, owner) on every User Permission change; status
+    # rides along for the Queued / Started lookups Frappe itself makes
+    # on the same pair
+    frappe.db.add_index(
+        "Prepared Report",
+        ["report_name", "owner", "status"],
+        "avientek_report_owner_status",
+    )
@@ -0,0 +1,22 @@
+import frappe
+
+# (doctype, columns, index name) for the filter / join paths of the
+# Stock Allocation and Batch-wise Free Stock Ageing reports
+REPORT_INDEXES = [
+    # open Sales Orders, read oldest first
+    ("Sales Order", ["status", "docstatus", "transaction_date"], "avientek_status_docstatus_date"),
+    # batch-wise SLE scan up to the report's To Date
+    (
+        "Stock Ledger Entry",
+        ["item_code", "warehouse", "batch_no", "posting_date"],
+        "avientek_item_wh_batch_date",
+    ),
+    # PO qty per SO line
+    ("Purchase Order Item", ["sales_order_item"], "avientek_sales_order_item"),
+]
+
+
+def execute():
+    # add_index skips indexes that already exist, so this is safe to re-run
+    for doctype, columns, index_name in REPORT_INDEXES:
+        frappe.db.add_index(doctype, columns, index_name)
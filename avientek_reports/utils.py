@@ -4,7 +4,10 @@
 #
 
 import json
+from concurrent.futures import ThreadPoolExecutor
+
 import frappe
+from frappe.model.document import Document
 from frappe.utils.background_jobs import enqueue
 
 # ----------------------------------------------------------------------
@@ -13,6 +16,7 @@ from frappe.utils.background_jobs import enqueue
 
 REPORT_NAME = "Avientek Stock Allocation"   # must match Report.title
 DEFAULT_FILTERS = {}                        # same defaults used in UI
+DEFAULT_FILTERS_JSON = json.dumps(DEFAULT_FILTERS, separators=(",", ":"))
 
 
 def rebuild_stock_allocation(login_manager=None, doc=None, method=None):
@@ -20,52 +24,137 @@ def rebuild_stock_allocation(login_manager=None, doc=None, method=None):
     Delete any cached Prepared Report for this user and enqueue a new one.
     Can be called from  ⸺
       • the on_session_creation hook            (login_manager argument)
-      • a User Permission doc_event             (doc argument)
+      • a User Permission change                (doc argument; deferred
+                                                 to the commit, see
+                                                 queue_stock_allocation_rebuild)
     """
 
     # --------------------------------------------------------------
     #  1) work out which user needs the rebuild
     # --------------------------------------------------------------
+    # doc_events call handlers positionally as (doc, method), so a
+    # document can arrive in the login_manager slot: it is a permission
+    # change, never a login
+    if isinstance(login_manager, Document):
+        login_manager, doc = None, login_manager
+
+    if doc is not None and not login_manager:
+        queue_stock_allocation_rebuild(doc)
+        return
+
     if login_manager:                     # called via on_session_creation
         user = login_manager.user
-    elif doc and hasattr(doc, "user"):    # called via User Permission hook
-        user = doc.user
     else:                                 # fallback (shouldn't happen)
         user = frappe.session.user
 
-    # Ensure we run as Administrator to bypass owner filtering
-    if frappe.session.user != "Administrator":
-        frappe.set_user("Administrator")
+    # A login only needs a report to exist: skip it while this user's
+    # rebuild is still pending or running
+    _purge_and_enqueue((user,), deduplicate=True)
+
+
+def queue_stock_allocation_rebuild(doc, method=None):
+    """
+    User Permission doc_event. Only records the user; every user touched
+    in the transaction is rebuilt once, just before it commits — so a
+    bulk import of N permissions costs one DELETE, not N.
+    """
+    pending = getattr(frappe.local, "avientek_pending_rebuilds", None)
+    if pending is None:
+        pending = frappe.local.avientek_pending_rebuilds = set()
+        frappe.db.before_commit.add(_flush_pending_rebuilds)
+        frappe.db.after_rollback.add(_discard_pending_rebuilds)
+    pending.add(doc.user)
+
 
+def _flush_pending_rebuilds():
+    users = getattr(frappe.local, "avientek_pending_rebuilds", None)
+    frappe.local.avientek_pending_rebuilds = None
+    if not users:
+        return
+
+    _purge_and_enqueue(sorted(users))
+
+
+def _discard_pending_rebuilds():
+    # the permission changes were rolled back, and with them the flush
+    frappe.local.avientek_pending_rebuilds = None
+
+
+def _purge_and_enqueue(users, deduplicate=False):
+    # No user switch needed: frappe.db.delete and enqueue do not apply
+    # permissions, and the job is told explicitly whom to build for
     # --------------------------------------------------------------
     #  2) purge any existing prepared-report rows
+    #     (Queued / Started ones included, so there is nothing left
+    #     to check for a pending rebuild afterwards)
     # --------------------------------------------------------------
     frappe.db.delete(
         "Prepared Report",
-        {"report_name": REPORT_NAME, "owner": user},
+        {"report_name": REPORT_NAME, "owner": ("in", users)},
     )
 
-    # If another rebuild job is already queued, skip double-enqueue
-    if frappe.db.exists(
-        "Prepared Report",
-        {
-            "report_name": REPORT_NAME,
-            "owner": user,
-            "status": ("in", ["Queued", "Started"]),
-        },
-    ):
-        return
-
     # --------------------------------------------------------------
-    #  3) enqueue a fresh background job
+    #  3) enqueue a fresh background job per user, once the purge
+    #     above is committed and visible to the worker. Permission
+    #     changes always enqueue (RQ assigns a unique job id): a job
+    #     already running may be building on the old permissions.
     # --------------------------------------------------------------
-    enqueue(
-        "frappe.core.doctype.prepared_report.prepared_report.enqueue_prepared_report",
-        report_name=REPORT_NAME,
-        filters=json.dumps(DEFAULT_FILTERS),
-        user=user,
-        queue="default",             # same queue Frappe uses in UI
-    )
+    for user in users:
+        enqueue(
+            "frappe.core.doctype.prepared_report.prepared_report.enqueue_prepared_report",
+            report_name=REPORT_NAME,
+            filters=DEFAULT_FILTERS_JSON,
+            user=user,
+            queue="short",
+            job_id=f"avientek-rebuild-{user}" if deduplicate else None,
+            deduplicate=deduplicate,
+            enqueue_after_commit=True,
+        )
+
+        # Optional: log for troubleshooting
+        frappe.logger().info(f"[PreparedReport] Rebuild queued for {user}")
+
+
+# ----------------------------------------------------------------------
+#  Query helpers
+# ----------------------------------------------------------------------
+
+def chunked(seq, size=1000):
+    """
+    Yield `seq` as tuples of at most `size` items, ready to bind to an
+    `IN %(name)s` placeholder. Keeps each statement (and the packet it
+    is sent in) bounded however many keys a report collects.
+    """
+    seq = tuple(seq)
+    for start in range(0, len(seq), size):
+        yield seq[start:start + size]
+
+
+# ----------------------------------------------------------------------
+#  Concurrent read-only queries
+# ----------------------------------------------------------------------
+
+def run_in_parallel(*calls, max_workers=4):
+    """
+    Run independent read-only lookups concurrently and return their
+    results in order. Each call is a tuple `(fn, *args)`.
+
+    Every worker thread opens its own site context and DB connection
+    (frappe.local is per-thread), runs as the current user, and tears
+    the connection down afterwards — so `fn` must not rely on state of
+    the caller's transaction.
+    """
+    site, sites_path, user = frappe.local.site, frappe.local.sites_path, frappe.session.user
+
+    def _run(call):
+        fn, args = call[0], call[1:]
+        frappe.init(site=site, sites_path=sites_path)
+        try:
+            frappe.connect()
+            frappe.set_user(user)
+            return fn(*args)
+        finally:
+            frappe.destroy()
 
-    # Optional: log for troubleshooting
-    frappe.logger().info(f"[PreparedReport] Rebuild queued for {user}")
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(calls)) or 1) as pool:
+        return list(pool.map(_run, calls))